@@ -1,134 +1,283 @@
 """Vercel serverless function — proxies AI requests to Anthropic.
 
 Set ANTHROPIC_API_KEY as an environment variable in the Vercel dashboard.
+The local dev server (server.py) reuses this handler.
 """
 
 import hashlib
+import http.client
 import json
 import os
+import sqlite3
+import ssl
+import tempfile
+import threading
 import time
-import urllib.request
-import urllib.error
+from collections import OrderedDict
 from http.server import BaseHTTPRequestHandler
 
-ANTHROPIC_URL = "https://api.anthropic.com/v1/messages"
+ANTHROPIC_HOST = "api.anthropic.com"
+ANTHROPIC_PATH = "/v1/messages"
+_SSL_CTX = ssl.create_default_context()  # built once; loading the CA store per connection is slow
 AI_MODEL = "claude-opus-4-6"
+API_KEY = os.environ.get("ANTHROPIC_API_KEY", "")
 
 MAX_REQUESTS_PER_HOUR = 10
 CACHE_TTL = 3600  # 1 hour
+MAX_BODY_BYTES = 64 * 1024
 
-RATE_LIMIT_PATH = "/tmp/rate_limits.json"
-RESPONSE_CACHE_PATH = "/tmp/response_cache.json"
+# Compact, UTF-8 JSON: non-ASCII text is sent as-is rather than \uXXXX-escaped
+_json_encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
 
 
-def _load_json(path):
-    try:
-        with open(path, "r") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError, OSError):
-        return {}
+def _dumps(obj):
+    return _json_encode(obj).encode()
 
 
-def _save_json(path, data):
-    try:
-        with open(path, "w") as f:
-            json.dump(data, f)
-    except OSError:
-        pass
+# Messages API request body, split around the two per-request fields
+_PAYLOAD_PREFIX = b'{"model":' + _dumps(AI_MODEL) + b',"max_tokens":'
+_PAYLOAD_MID = b',"messages":[{"role":"user","content":'
+_PAYLOAD_SUFFIX = b"}]}"
 
 
-def _check_rate_limit(ip):
-    limits = _load_json(RATE_LIMIT_PATH)
+def _build_payload(prompt, max_tokens):
+    return b"".join((_PAYLOAD_PREFIX, _dumps(max_tokens), _PAYLOAD_MID, _dumps(prompt), _PAYLOAD_SUFFIX))
+
+
+DB_PATH = os.path.join(tempfile.gettempdir(), "superbowl-lx-cache.db")
+EVICT_EVERY = 64  # writes between sweeps of expired rows
+HOT_CACHE_SIZE = 64
+HTTP_POOL_SIZE = 8  # idle Anthropic connections kept for reuse
+ANTHROPIC_TIMEOUT = 60  # seconds to wait on the socket for Anthropic
+
+_dbs = {}  # path -> open connection
+_writes_since_evict = 0
+_hot = OrderedDict()  # prompt_hash -> (body, ts) for recently used prompts, oldest first
+_state_lock = threading.Lock()  # guards the state above when served from threads (server.py)
+_idle_http = []  # kept-alive connections to ANTHROPIC_HOST not currently in use
+_idle_lock = threading.Lock()
+
+
+def _conn(path):
+    """Open the SQLite store at path once per instance and create its tables.
+
+    Raises sqlite3.Error if the store is unusable; callers then carry on
+    without it, as the JSON files before it did on OSError.
+    """
+    db = _dbs.get(path)
+    if db is None:
+        db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS responses (hash BLOB PRIMARY KEY, body BLOB, ts REAL)")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS ratelimit "
+                "(ip TEXT PRIMARY KEY, count INTEGER, window_start REAL)"
+            )
+        except sqlite3.Error:
+            db.close()
+            raise
+        _dbs[path] = db
+    return db
+
+
+def _maybe_evict(db, now):
+    global _writes_since_evict
+    _writes_since_evict += 1
+    if _writes_since_evict < EVICT_EVERY:
+        return
+    _writes_since_evict = 0
+    db.execute("DELETE FROM responses WHERE ts <= ?", (now - CACHE_TTL,))
+    db.execute("DELETE FROM ratelimit WHERE window_start < ?", (now - 3600,))
+
+
+# Counts the request and starts a new window if the old one expired; the
+# update is skipped (no row changed) when the IP is already at the limit.
+_RATE_LIMIT_SQL = """
+    INSERT INTO ratelimit (ip, count, window_start) VALUES (?1, 1, ?2)
+    ON CONFLICT(ip) DO UPDATE SET
+        count = CASE WHEN ?2 - window_start > 3600 THEN 1 ELSE count + 1 END,
+        window_start = CASE WHEN ?2 - window_start > 3600 THEN ?2 ELSE window_start END
+    WHERE ?2 - window_start > 3600 OR count < ?3
+"""
+
+
+def _check_rate_limit(path, ip):
     now = time.time()
-    record = limits.get(ip, {"count": 0, "window_start": now})
-    if now - record["window_start"] > 3600:
-        record = {"count": 0, "window_start": now}
-    if record["count"] >= MAX_REQUESTS_PER_HOUR:
-        return False
-    record["count"] += 1
-    limits[ip] = record
-    # Evict expired entries
-    limits = {k: v for k, v in limits.items() if now - v["window_start"] <= 3600}
-    _save_json(RATE_LIMIT_PATH, limits)
-    return True
-
-
-def _get_cached(prompt_hash):
-    cache = _load_json(RESPONSE_CACHE_PATH)
-    entry = cache.get(prompt_hash)
-    if entry and time.time() - entry["ts"] < CACHE_TTL:
-        return entry["text"]
-    return None
-
-
-def _set_cached(prompt_hash, text):
-    cache = _load_json(RESPONSE_CACHE_PATH)
+    with _state_lock:
+        try:
+            db = _conn(path)
+            allowed = db.execute(_RATE_LIMIT_SQL, (ip, now, MAX_REQUESTS_PER_HOUR)).rowcount > 0
+            if allowed:
+                _maybe_evict(db, now)
+        except sqlite3.Error:
+            # Fail open: an unusable store should not take the AI features down
+            return True
+    return allowed
+
+
+def _remember(prompt_hash, body, ts):
+    _hot[prompt_hash] = (body, ts)
+    _hot.move_to_end(prompt_hash)
+    if len(_hot) > HOT_CACHE_SIZE:
+        _hot.popitem(last=False)
+
+
+def _get_cached(path, prompt_hash):
+    """Return the encoded JSON response body cached for prompt_hash, if fresh."""
+    cutoff = time.time() - CACHE_TTL
+    with _state_lock:
+        entry = _hot.get(prompt_hash)
+        if entry and entry[1] > cutoff:
+            _hot.move_to_end(prompt_hash)
+            return entry[0]
+        try:
+            row = _conn(path).execute(
+                "SELECT body, ts FROM responses WHERE hash = ? AND ts > ?",
+                (prompt_hash, cutoff),
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+        if not row:
+            return None
+        _remember(prompt_hash, *row)
+    return row[0]
+
+
+def _set_cached(path, prompt_hash, body):
     now = time.time()
-    cache[prompt_hash] = {"text": text, "ts": now}
-    # Evict expired entries
-    cache = {k: v for k, v in cache.items() if now - v["ts"] < CACHE_TTL}
-    _save_json(RESPONSE_CACHE_PATH, cache)
+    with _state_lock:
+        _remember(prompt_hash, body, now)
+        try:
+            db = _conn(path)
+            db.execute("INSERT OR REPLACE INTO responses (hash, body, ts) VALUES (?, ?, ?)", (prompt_hash, body, now))
+            _maybe_evict(db, now)
+        except sqlite3.Error:
+            pass
+
+
+def _anthropic_post(payload, api_key):
+    """POST to the Messages API over a pooled kept-alive connection; returns (status, body)."""
+    headers = {
+        "Content-Type": "application/json",
+        "x-api-key": api_key,
+        "anthropic-version": "2023-06-01",
+    }
+    for attempt in range(2):
+        conn = None
+        if not attempt:
+            with _idle_lock:
+                conn = _idle_http.pop() if _idle_http else None
+        reused = conn is not None
+        if conn is None:
+            conn = http.client.HTTPSConnection(ANTHROPIC_HOST, timeout=ANTHROPIC_TIMEOUT, context=_SSL_CTX)
+        try:
+            conn.request("POST", ANTHROPIC_PATH, body=payload, headers=headers)
+            resp = conn.getresponse()
+            result = resp.status, resp.read()
+        except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+            conn.close()
+            if attempt or not reused:
+                raise
+            # An idle keep-alive connection was dropped by the server. The rest of
+            # the pool idled just as long, so discard it and retry on a new connection.
+            with _idle_lock:
+                stale, _idle_http[:] = _idle_http[:], []
+            for c in stale:
+                c.close()
+            continue
+        except Exception:
+            conn.close()
+            raise
+        with _idle_lock:
+            if len(_idle_http) < HTTP_POOL_SIZE:
+                _idle_http.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+        return result
 
 
 class handler(BaseHTTPRequestHandler):
+    api_key = API_KEY  # server.py overrides this with the key from config.toml
+    db_path = DB_PATH  # server.py overrides this with a per-process in-memory store
+
     def do_POST(self):
-        api_key = os.environ.get("ANTHROPIC_API_KEY", "")
-        if not api_key:
+        if not self.api_key:
             self._respond(503, {"error": "API key not configured"})
             return
 
-        length = int(self.headers.get("Content-Length", 0))
         try:
-            body = json.loads(self.rfile.read(length)) if length else {}
-        except (json.JSONDecodeError, TypeError):
-            body = {}
-
-        prompt = body.get("prompt", "")
-        max_tokens = body.get("max_tokens", 300)
-
-        if not prompt:
+            length = max(int(self.headers.get("Content-Length")), 0)
+        except (TypeError, ValueError):
+            length = 0
+        if length > MAX_BODY_BYTES:
+            self._respond(413, {"error": "Request body too large"})
+            return
+        body = None
+        if length:
+            try:
+                body = json.loads(self.rfile.read(length))
+            except ValueError:
+                pass
+        prompt = body.get("prompt") if isinstance(body, dict) else None
+        if not prompt or not isinstance(prompt, str):
             self._respond(400, {"error": "prompt is required"})
             return
+        max_tokens = body.get("max_tokens", 300)
+        try:
+            # Lone surrogates (e.g. a JSON "\ud800" escape) have no UTF-8 form
+            prompt_bytes = prompt.encode()
+        except UnicodeEncodeError:
+            self._respond(400, {"error": "prompt is not valid text"})
+            return
 
         # Check response cache (cached responses are free — skip rate limit)
-        prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()
-        cached = _get_cached(prompt_hash)
+        prompt_hash = hashlib.sha256(prompt_bytes).digest()
+        cached = _get_cached(self.db_path, prompt_hash)
         if cached:
-            self._respond(200, {"text": cached})
+            self._send_body(200, cached)
+            return
+
+        try:
+            payload = _build_payload(prompt, max_tokens)
+        except UnicodeEncodeError:
+            self._respond(400, {"error": "max_tokens is invalid"})
             return
 
         # Rate limit only uncached requests (these hit the Anthropic API)
-        ip = (self.headers.get("X-Forwarded-For") or "unknown").split(",")[0].strip()
-        if not _check_rate_limit(ip):
+        ip = self._client_ip()
+        if not _check_rate_limit(self.db_path, ip):
             self._respond(429, {"error": "Rate limit exceeded. Try again later."})
             return
 
-        payload = json.dumps({
-            "model": AI_MODEL,
-            "max_tokens": max_tokens,
-            "messages": [{"role": "user", "content": prompt}],
-        }).encode()
-
-        req = urllib.request.Request(ANTHROPIC_URL, data=payload, headers={
-            "Content-Type": "application/json",
-            "x-api-key": api_key,
-            "anthropic-version": "2023-06-01",
-        })
-
         try:
-            with urllib.request.urlopen(req) as resp:
-                data = json.loads(resp.read())
+            status, raw = _anthropic_post(payload, self.api_key)
+            if status != 200:
+                err_body = raw.decode(errors="replace")
+                self._respond(502, {"error": f"Anthropic API error: {status} {err_body}"})
+                return
+            data = json.loads(raw)
             text = data.get("content", [{}])[0].get("text", "No response generated.")
-            _set_cached(prompt_hash, text)
-            self._respond(200, {"text": text})
-        except urllib.error.HTTPError as e:
-            err_body = e.read().decode(errors="replace")
-            self._respond(502, {"error": f"Anthropic API error: {e.code} {err_body}"})
+            body = _dumps({"text": text})
+            _set_cached(self.db_path, prompt_hash, body)
+            self._send_body(200, body)
+        except TimeoutError:
+            self._respond(504, {"error": "Anthropic API timed out"})
         except Exception as e:
             self._respond(500, {"error": str(e)})
 
+    def _client_ip(self):
+        # First hop only; avoid splitting long proxy chains into a list
+        xff = self.headers.get("X-Forwarded-For") or "unknown"
+        comma = xff.find(",")
+        return (xff if comma < 0 else xff[:comma]).strip()
+
     def _respond(self, status, obj):
-        body = json.dumps(obj).encode()
+        self._send_body(status, _dumps(obj))
+
+    def _send_body(self, status, body):
         self.send_response(status)
         self.send_header("Content-Type", "application/json")
         self.send_header("Content-Length", str(len(body)))
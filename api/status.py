@@ -4,13 +4,17 @@ import json
 import os
 from http.server import BaseHTTPRequestHandler
 
+API_KEY = os.environ.get("ANTHROPIC_API_KEY", "")
+
+# The answer cannot change for the life of the instance, so encode it once
+_BODY = json.dumps({"ai_enabled": bool(API_KEY)}).encode()
+_CONTENT_LENGTH = str(len(_BODY))
+
 
 class handler(BaseHTTPRequestHandler):
     def do_GET(self):
-        ai_enabled = bool(os.environ.get("ANTHROPIC_API_KEY", ""))
-        body = json.dumps({"ai_enabled": ai_enabled}).encode()
         self.send_response(200)
         self.send_header("Content-Type", "application/json")
-        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Content-Length", _CONTENT_LENGTH)
         self.end_headers()
-        self.wfile.write(body)
+        self.wfile.write(_BODY)
@@ -7,24 +7,21 @@ Requires Python 3.11+ (uses built-in tomllib).
 Reads API key from config.toml — copy config.example.toml to get started.
 """
 
-import hashlib
 import http.server
 import json
 import os
 import sys
-import time
-import urllib.request
-import urllib.error
 
 try:
     import tomllib
 except ModuleNotFoundError:
     sys.exit("Python 3.11+ is required (for built-in tomllib). You have Python " + sys.version.split()[0])
 
+from api import analyze
+
 PORT = 8080
-ANTHROPIC_URL = "https://api.anthropic.com/v1/messages"
-AI_MODEL = "claude-opus-4-6"
 ROOT = os.path.dirname(os.path.abspath(__file__))
+INDEX_PATH = os.path.join(ROOT, "superbowl-lx.html")
 
 
 def load_api_key():
@@ -40,123 +37,80 @@ def load_api_key():
 
 
 API_KEY = load_api_key()
+_STATUS_BODY = json.dumps({"ai_enabled": bool(API_KEY)}).encode()  # same bytes as api/status.py
 
-MAX_REQUESTS_PER_HOUR = 10
-CACHE_TTL = 3600  # 1 hour
-_rate_limits = {}   # ip -> {"count": int, "window_start": float}
-_response_cache = {}  # prompt_hash -> {"text": str, "ts": float}
-
-
-def _check_rate_limit(ip):
-    now = time.time()
-    record = _rate_limits.get(ip, {"count": 0, "window_start": now})
-    if now - record["window_start"] > 3600:
-        record = {"count": 0, "window_start": now}
-    if record["count"] >= MAX_REQUESTS_PER_HOUR:
-        return False
-    record["count"] += 1
-    _rate_limits[ip] = record
-    return True
 
+_index = None  # ((mtime_ns, size), etag, body) of INDEX_PATH
 
-def _get_cached(prompt_hash):
-    entry = _response_cache.get(prompt_hash)
-    if entry and time.time() - entry["ts"] < CACHE_TTL:
-        return entry["text"]
-    return None
 
+def _load_index():
+    """Return the app page from memory, re-reading it only when the file changes."""
+    global _index
+    st = os.stat(INDEX_PATH)
+    key = (st.st_mtime_ns, st.st_size)
+    if _index is None or _index[0] != key:
+        with open(INDEX_PATH, "rb") as f:
+            body = f.read()
+        _index = (key, f'"{st.st_mtime_ns:x}-{st.st_size:x}"', body)
+    return _index
 
-def _set_cached(prompt_hash, text):
-    now = time.time()
-    _response_cache[prompt_hash] = {"text": text, "ts": now}
-    # Evict expired entries
-    expired = [k for k, v in _response_cache.items() if now - v["ts"] >= CACHE_TTL]
-    for k in expired:
-        del _response_cache[k]
 
+class Handler(analyze.handler, http.server.SimpleHTTPRequestHandler):
+    api_key = API_KEY
+    # Keep the cache and rate limits in memory so a restart clears them; all
+    # local traffic shares 127.0.0.1 and would otherwise stay limited for an hour
+    db_path = ":memory:"
 
-class Handler(http.server.SimpleHTTPRequestHandler):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory=ROOT, **kwargs)
 
     def do_GET(self):
-        if self.path == "/":
-            self.path = "/superbowl-lx.html"
-            return super().do_GET()
+        if self.path in ("/", "/superbowl-lx.html"):
+            self._send_index()
+            return
         if self.path == "/api/status":
-            self._json_response({"ai_enabled": bool(API_KEY)})
+            self._send_body(200, _STATUS_BODY)
             return
         return super().do_GET()
 
-    def do_POST(self):
-        if self.path == "/api/analyze":
-            self._handle_analyze()
+    def _send_index(self):
+        _, etag, body = _load_index()
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
             return
-        self.send_error(404)
-
-    def _handle_analyze(self):
-        if not API_KEY:
-            self._json_response({"error": "API key not configured"}, status=503)
-            return
-
-        length = int(self.headers.get("Content-Length", 0))
-        body = json.loads(self.rfile.read(length)) if length else {}
-        prompt = body.get("prompt", "")
-        max_tokens = body.get("max_tokens", 300)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
 
-        if not prompt:
-            self._json_response({"error": "prompt is required"}, status=400)
+    def copyfile(self, source, outputfile):
+        if outputfile is self.wfile:
+            # Static files go from the page cache straight to the socket via
+            # os.sendfile; socket.sendfile falls back to send() where unsupported
+            self.connection.sendfile(source)
             return
+        super().copyfile(source, outputfile)
 
-        # Check response cache (cached responses are free — skip rate limit)
-        prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()
-        cached = _get_cached(prompt_hash)
-        if cached:
-            self._json_response({"text": cached})
+    def do_POST(self):
+        if self.path == "/api/analyze":
+            super().do_POST()
             return
+        self.send_error(404)
 
-        # Rate limit only uncached requests (these hit the Anthropic API)
-        ip = self.client_address[0]
-        if not _check_rate_limit(ip):
-            self._json_response({"error": "Rate limit exceeded. Try again later."}, status=429)
-            return
+    def _client_ip(self):
+        # No proxy in front of the dev server, so X-Forwarded-For is not trusted
+        return self.client_address[0]
 
-        payload = json.dumps({
-            "model": AI_MODEL,
-            "max_tokens": max_tokens,
-            "messages": [{"role": "user", "content": prompt}],
-        }).encode()
-
-        req = urllib.request.Request(ANTHROPIC_URL, data=payload, headers={
-            "Content-Type": "application/json",
-            "x-api-key": API_KEY,
-            "anthropic-version": "2023-06-01",
-        })
-
-        try:
-            with urllib.request.urlopen(req) as resp:
-                data = json.loads(resp.read())
-            text = data.get("content", [{}])[0].get("text", "No response generated.")
-            _set_cached(prompt_hash, text)
-            self._json_response({"text": text})
-        except urllib.error.HTTPError as e:
-            err_body = e.read().decode(errors="replace")
-            self._json_response({"error": f"Anthropic API error: {e.code} {err_body}"}, status=502)
-        except Exception as e:
-            self._json_response({"error": str(e)}, status=500)
-
-    def _json_response(self, obj, status=200):
-        body = json.dumps(obj).encode()
-        self.send_response(status)
-        self.send_header("Content-Type", "application/json")
-        self.send_header("Content-Length", str(len(body)))
+    def end_headers(self):
         self.send_header("Access-Control-Allow-Origin", "*")
-        self.end_headers()
-        self.wfile.write(body)
+        super().end_headers()
 
     def do_OPTIONS(self):
         self.send_response(204)
-        self.send_header("Access-Control-Allow-Origin", "*")
         self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
         self.send_header("Access-Control-Allow-Headers", "Content-Type")
         self.end_headers()
@@ -169,7 +123,7 @@ class Handler(http.server.SimpleHTTPRequestHandler):
 if __name__ == "__main__":
     ai_status = "enabled" if API_KEY else "disabled (set key in config.toml)"
     print(f"Serving at http://localhost:{PORT} — AI: {ai_status}")
-    server = http.server.HTTPServer(("", PORT), Handler)
+    server = http.server.ThreadingHTTPServer(("", PORT), Handler)
     try:
         server.serve_forever()
     except KeyboardInterrupt: